@@ -0,0 +1,67 @@
+"""
+Numerical kernels for the truth catalog flux computations.
+
+The kernels are JIT compiled with numba when it is available and fall
+back to equivalent numpy expressions otherwise, so numba stays an
+optional dependency.
+"""
+
+from __future__ import absolute_import, division
+import numpy as np
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+__all__ = ['snr_from_m5']
+
+
+def _snr_from_m5_numpy(mags, m5, gamma):
+    flux_ratio = np.power(10., 0.4*(mags[None, :] - m5[:, None]))
+    return 1.0/np.sqrt((0.04 - gamma)*flux_ratio +
+                       gamma*flux_ratio*flux_ratio)
+
+
+if njit is not None:
+    @njit(parallel=True, cache=True, fastmath=True)
+    def _snr_from_m5_numba(mags, m5, gamma):
+        out = np.empty((m5.size, mags.size))
+        for i in prange(m5.size):
+            for j in range(mags.size):
+                flux_ratio = 10.0 ** (0.4*(mags[j] - m5[i]))
+                out[i, j] = 1.0/np.sqrt((0.04 - gamma)*flux_ratio +
+                                        gamma*flux_ratio*flux_ratio)
+        return out
+
+
+def snr_from_m5(mags, m5, gamma):
+    """
+    Evaluate the calcSNR_m5 signal-to-noise expression on a
+    (visits, stars) grid.
+
+    This is the flux-ratio formula from the LSST overview paper that
+    `lsst.sims.photUtils.SignalToNoise.calcSNR_m5` evaluates for a single
+    five sigma depth, applied to all the visits of a filter at once.
+
+    Parameters
+    ----------
+    mags : numpy array
+        The magnitudes of the stars in the filter.
+    m5 : numpy array
+        The five sigma depth of each visit.
+    gamma : float
+        The photometric gamma factor of the filter.
+
+    Returns
+    ----------
+    snr : numpy array
+        Array of shape (len(m5), len(mags)) holding the signal to noise
+        of every star in every visit.
+    """
+
+    mags = np.asarray(mags, dtype=np.float64)
+    m5 = np.asarray(m5, dtype=np.float64)
+    if njit is not None:
+        return _snr_from_m5_numba(mags, m5, gamma)
+    return _snr_from_m5_numpy(mags, m5, gamma)
@@ -11,6 +11,8 @@ from __future__ import print_function
 from __future__ import absolute_import, division
 
 import os
+import re
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import sncosmo
@@ -407,11 +409,11 @@ class Monitor(object):
             visit_list = all_visits['visit_id']
 
         print('Querying for object fluxes')
-        obs_flux_table = pd.DataFrame(columns=('obs_object_id',
-                                               'visit_id',
-                                               'filter',
-                                               'psf_flux',
-                                               'psf_flux_err'))
+        obs_flux_columns = ('obs_object_id', 'visit_id', 'filter',
+                            'psf_flux', 'psf_flux_err')
+        # Collect one frame per object and concatenate once; appending to
+        # a growing dataframe copies all accumulated rows on every object.
+        obj_flux_frames = []
         obj_queried = 0
         for obs_id in self.matched_ids['obs_object_id']:
             if obj_queried % 100 == 0:
@@ -419,23 +421,17 @@ class Monitor(object):
                                                        len(self.matched_ids)))
             obj_queried += 1
             obj_flux = self.dbConn.all_fs_visits_from_id(obs_id)
-            obs_flux_table = obs_flux_table.append(pd.DataFrame(np.array(
-                                            [obj_flux['object_id'],
-                                             obj_flux['visit_id'],
-                                             obj_flux['filter'],
-                                             obj_flux['psf_flux'],
-                                             obj_flux['psf_flux_err']]).T,
-                                            columns=obs_flux_table.columns),
-                                            ignore_index=True)
-
-        obs_flux_table['obs_object_id'] = pd.to_numeric(
-            obs_flux_table['obs_object_id'])
-        obs_flux_table['visit_id'] = pd.to_numeric(
-            obs_flux_table['visit_id'])
-        obs_flux_table['psf_flux'] = pd.to_numeric(
-            obs_flux_table['psf_flux'])
-        obs_flux_table['psf_flux_err'] = pd.to_numeric(
-            obs_flux_table['psf_flux_err'])
+            # Keep the typed recarray columns as they are; stacking them
+            # through np.array(...).T would upcast everything to object
+            # dtype and force a numeric re-conversion afterwards.
+            obj_flux_frames.append(pd.DataFrame(
+                            {'obs_object_id': obj_flux['object_id'],
+                             'visit_id': obj_flux['visit_id'],
+                             'filter': obj_flux['filter'],
+                             'psf_flux': obj_flux['psf_flux'],
+                             'psf_flux_err': obj_flux['psf_flux_err']},
+                            columns=obs_flux_columns))
+        obs_flux_table = pd.concat(obj_flux_frames, ignore_index=True)
 
         flux_statistics = []
         for visit_num in visit_list:
@@ -763,6 +759,54 @@ class Monitor(object):
 
 # =============================================================================
 
+_BANDPASS_CACHE = {}
+
+# Naming convention of the per-visit forced photometry directories,
+# e.g. 'v840-fr' for visit 840 in the r band.
+_VISIT_DIR_RE = re.compile(r'^v(\d+)-f([ugrizy])$')
+
+
+def _load_bandpass(filter_name):
+    """
+    Load the baseline total throughput for an LSST filter as a structured
+    array with 'wavelen' and 'transmission' fields.
+
+    The arrays are cached at module level, so the files are only read once
+    per session no matter how many curve objects are constructed.
+    """
+    if filter_name in _BANDPASS_CACHE:
+        return _BANDPASS_CACHE[filter_name]
+    bandpass_file = os.path.join(getPackageDir('throughputs'), 'baseline',
+                                 'total_' + filter_name + '.dat')
+    bandpass_info = np.loadtxt(bandpass_file,
+                               dtype=[('wavelen', 'f8'),
+                                      ('transmission', 'f8')])
+    _BANDPASS_CACHE[filter_name] = bandpass_info
+    return bandpass_info
+
+
+_REGISTERED_BANDPASSES = set()
+
+
+def _ensure_bandpasses_registered(filter_list):
+    """
+    Register the LSST bandpasses with sncosmo once per session.
+
+    Each filter is registered the first time it is requested and skipped
+    afterwards, so constructing many curve objects does not re-read the
+    throughput files or lean on sncosmo's already-registered exception.
+    """
+    for filter_name in filter_list:
+        if filter_name in _REGISTERED_BANDPASSES:
+            continue
+        bandpass_info = _load_bandpass(filter_name)
+        band = sncosmo.Bandpass(bandpass_info['wavelen'],
+                                bandpass_info['transmission'],
+                                name=str('lsst' + filter_name),
+                                wave_unit=u.nm)
+        sncosmo.registry.register(band, force=True)
+        _REGISTERED_BANDPASSES.add(filter_name)
+
 
 class BaseCurve(object):
     """
@@ -791,20 +835,7 @@ class BaseCurve(object):
         self.dbConn_lc = dbConn
         self.filter_list = filter_list
 
-        for filter_name in filter_list:
-            bandpass_file = os.path.join(str(getPackageDir('throughputs') +
-                                             '/baseline/total_' +
-                                             filter_name + '.dat'))
-            bandpass_info = np.genfromtxt(bandpass_file,
-                                          names=['wavelen', 'transmission'])
-            band = sncosmo.Bandpass(bandpass_info['wavelen'],
-                                    bandpass_info['transmission'],
-                                    name=str('lsst' + filter_name),
-                                    wave_unit=u.nm)
-            try:
-                sncosmo.registry.register(band)
-            except Exception:
-                continue
+        _ensure_bandpasses_registered(filter_list)
 
         if fp_table_dir is not None:
             self.fp_table_dir = fp_table_dir
@@ -812,18 +843,25 @@ class BaseCurve(object):
             self.visit_map = {x: [] for x in self.bandpasses}
             self.lightcurve = None
             self.visit_mjd = {}
+            self._fp_index = None
+            self._fp_cache = OrderedDict()
+            self._fp_cache_size = 256
 
             # Associate mjd with visits (just a hack for now)
             # The whole ability to read from the data repo should probably
             # be updated to use the butler if we want to keep this ability
-            mjd_list = np.genfromtxt(mjd_file, delimiter=',')
-            for visit_date in mjd_list:
-                self.visit_mjd[str(int(visit_date[0]))] = visit_date[1]
+            mjd_list = np.loadtxt(mjd_file, delimiter=',', ndmin=2)
+            visit_names = mjd_list[:, 0].astype(np.int64).astype(str)
+            self.visit_mjd = dict(zip(visit_names.tolist(),
+                                      mjd_list[:, 1].tolist()))
 
-            for visit_dir in os.listdir(str(fp_table_dir+'/0/')):
-                visit_band = visit_dir[-1]
-                visit_num = visit_dir[1:-3]
-                self.visit_map[visit_band].append(visit_num)
+            # scandir avoids building the full directory listing up front
+            # and the regex skips anything that is not a visit directory.
+            for entry in os.scandir(os.path.join(fp_table_dir, '0')):
+                match = _VISIT_DIR_RE.match(entry.name)
+                if match is None or not entry.is_dir(follow_symlinks=False):
+                    continue
+                self.visit_map[match.group(2)].append(match.group(1))
 
 
 class LightCurve(BaseCurve):
@@ -840,6 +878,51 @@ class LightCurve(BaseCurve):
 
         self.lightcurve = pd.DataFrame.from_dict(lc_dict)
 
+    def _fp_table_path(self, visit, bandpass):
+        """
+        Path of the forced photometry table for a visit and bandpass.
+        """
+        # NB. Hard-coded filename conventions:
+        return str(self.fp_table_dir + '/0/v' + str(visit) +
+                   '-f' + bandpass + '/R22/S11.fits')
+
+    def _open_fp_table(self, visit, bandpass):
+        """
+        Open a forced photometry table memory-mapped, so only the columns
+        that are accessed get paged in, and keep up to _fp_cache_size
+        tables open so repeated lightcurve builds in the same session
+        reuse the handles instead of re-opening the files.
+        """
+        key = (bandpass, visit)
+        if key in self._fp_cache:
+            return self._fp_cache[key]
+        hdulist = fits.open(self._fp_table_path(visit, bandpass),
+                            memmap=True, lazy_load_hdus=True)
+        if len(self._fp_cache) >= self._fp_cache_size:
+            # Drop the oldest handle; the memmap holds a file descriptor.
+            _, old_hdulist = self._fp_cache.popitem(last=False)
+            old_hdulist.close()
+        self._fp_cache[key] = hdulist
+        return hdulist
+
+    def _build_fp_index(self):
+        """
+        Scan each forced photometry table once and map each object id to
+        the (bandpass, visit, row) entries that contain it.
+
+        Building a lightcurve then only touches the rows for that object
+        instead of re-scanning the objectId column of every table, so the
+        scan cost is paid once per session rather than once per object.
+        """
+        self._fp_index = {}
+        for bandpass in self.bandpasses:
+            for visit in self.visit_map[bandpass]:
+                hdulist = self._open_fp_table(visit, bandpass)
+                object_ids = hdulist[1].data['objectId']
+                for row, object_id in enumerate(object_ids):
+                    self._fp_index.setdefault(object_id, []).append(
+                                                    (bandpass, visit, row))
+
     def build_lightcurve_from_fp_table(self, objid):
         """
         Assemble a light curve dataframe from available forced photometry
@@ -855,34 +938,40 @@ class LightCurve(BaseCurve):
         lightcurve : pandas dataframe
             The lightcurve information stored in a pandas dataframe.
         """
-        lightcurve = {}
-        lightcurve['bandpass'] = []
-        lightcurve['mjd'] = []
-        lightcurve['ra'] = []
-        lightcurve['dec'] = []
-        lightcurve['flux'] = []
-        lightcurve['flux_error'] = []
-        lightcurve['zp'] = []
-        lightcurve['zpsys'] = []
+        if self._fp_index is None:
+            self._build_fp_index()
+
+        # The index tells us exactly how many entries the object has, so
+        # fill preallocated typed arrays instead of appending the values
+        # to Python lists one boxed scalar at a time.
+        entries = self._fp_index.get(objid, [])
+        num_entries = len(entries)
+        bandpass_names = np.empty(num_entries, dtype='U6')
+        mjd = np.empty(num_entries, dtype=np.float64)
+        ra = np.empty(num_entries, dtype=np.float64)
+        dec = np.empty(num_entries, dtype=np.float64)
+        flux = np.empty(num_entries, dtype=np.float64)
+        flux_error = np.empty(num_entries, dtype=np.float64)
+
+        for on, (bandpass, visit, row) in enumerate(entries):
+            hdulist = self._open_fp_table(visit, bandpass)
+            obj_data = hdulist[1].data[row]
+            bandpass_names[on] = str('lsst' + bandpass)
+            mjd[on] = self.visit_mjd[str(visit)]
+            ra[on] = obj_data['coord_ra']
+            dec[on] = obj_data['coord_dec']
+            flux[on] = obj_data['base_PsfFlux_flux']
+            flux_error[on] = obj_data['base_PsfFlux_fluxSigma']
 
-        for bandpass in self.bandpasses:
-            for visit in self.visit_map[bandpass]:
-                # NB. Hard-coded filename conventions:
-                hdulist = fits.open(str(self.fp_table_dir + '/0/v' +
-                                        str(visit) +
-                                        '-f'+bandpass+'/R22/S11.fits'))
-                obj_idx = np.where(hdulist[1].data['objectId'] == objid)
-                obj_data = hdulist[1].data[obj_idx]
-                if len(obj_data) > 0:
-                    lightcurve['bandpass'].append(str('lsst' + bandpass))
-                    lightcurve['mjd'].append(self.visit_mjd[str(visit)])
-                    lightcurve['ra'].append(obj_data['coord_ra'][0])
-                    lightcurve['dec'].append(obj_data['coord_dec'][0])
-                    lightcurve['flux'].append(obj_data['base_PsfFlux_flux'][0])
-                    lightcurve['flux_error'].append(
-                                         obj_data['base_PsfFlux_fluxSigma'][0])
-                    lightcurve['zp'].append(25.0)
-                    lightcurve['zpsys'].append('ab')
+        lightcurve = {}
+        lightcurve['bandpass'] = bandpass_names
+        lightcurve['mjd'] = mjd
+        lightcurve['ra'] = ra
+        lightcurve['dec'] = dec
+        lightcurve['flux'] = flux
+        lightcurve['flux_error'] = flux_error
+        lightcurve['zp'] = np.full(num_entries, 25.0)
+        lightcurve['zpsys'] = np.full(num_entries, 'ab')
         self._build_lightcurve(lightcurve)
 
     def build_lightcurve_from_db(self, objid=None, ra_dec=None,
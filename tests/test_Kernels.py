@@ -0,0 +1,32 @@
+"""
+Unit tests for the numerical kernels.
+"""
+from __future__ import absolute_import
+import unittest
+import numpy as np
+from desc.monitor._kernels import snr_from_m5
+
+
+class SnrFromM5TestCase(unittest.TestCase):
+
+    def test_matches_direct_evaluation(self):
+        """
+        The kernel agrees with a direct numpy evaluation of the
+        calcSNR_m5 flux-ratio expression, whichever backend is active.
+        """
+        rng = np.random.RandomState(42)
+        mags = rng.uniform(15., 25., size=100)
+        m5 = rng.uniform(22., 25., size=7)
+        gamma = 0.039
+
+        flux_ratio = np.power(10., 0.4*(mags[None, :] - m5[:, None]))
+        expected = 1.0/np.sqrt((0.04 - gamma)*flux_ratio +
+                               gamma*flux_ratio*flux_ratio)
+
+        snr = snr_from_m5(mags, m5, gamma)
+        self.assertEqual(snr.shape, (len(m5), len(mags)))
+        np.testing.assert_allclose(snr, expected, rtol=1e-8)
+
+
+if __name__ == '__main__':
+    unittest.main()